@@ -10,13 +10,20 @@ import shutil
 import subprocess
 import argparse
 from urllib.request import urlopen, Request
-import tarfile
 import tempfile
-import io
-import glob
+import fnmatch
 import json
 import time
 import platform
+import atexit
+import re
+import ctypes
+import struct
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from macholib.MachO import MachO
+except ImportError:
+    MachO = None
 
 
 def getopts():
@@ -32,6 +39,9 @@ def getopts():
     p.add_argument('-p', '--prefix')
     p.add_argument('-n', '--no-dmg', action='store_true')
     p.add_argument('-d', '--dmg-name', default='ART')
+    p.add_argument('--slow-dmg', action='store_true',
+                   help='use bzip2 (UDBZ) instead of LZFSE (ULFO) for the '
+                   'dmg: slower, but produces a smaller file')
     p.add_argument('-s', '--shell', default='/bin/zsh')
     p.add_argument('-l', '--use-launcher', action='store_true', default=False)
     p.add_argument('-L', '--no-launcher', action='store_false',
@@ -39,6 +49,7 @@ def getopts():
     p.add_argument('--debug', action='store_true')
     ret = p.parse_args()
     ret.outdir = os.path.join(ret.outdir, 'ART.app')
+    ret.art_deps = None
     return ret
 
 
@@ -56,55 +67,191 @@ def get_imageio_releases():
     class RelInfo:
         def __init__(self, rel):
             self.rels = sorted(rel, key=key, reverse=True)
-            
-        def asset(self, name):
+            # in the same order asset() used to scan, so setdefault keeps the
+            # same match
+            self.by_name = {}
             for rel in self.rels:
                 for asset in rel['assets']:
-                    if asset['name'] == name:
-                        res = Request(asset['browser_download_url'])
-                        if auth is not None:
-                            res.add_header('authorization', 'Bearer ' + auth)
-                        return res
-            return None
+                    self.by_name.setdefault(asset['name'],
+                                            asset['browser_download_url'])
+            
+        def asset(self, name):
+            url = self.by_name.get(name)
+            if url is None:
+                return None
+            res = Request(url)
+            if auth is not None:
+                res.add_header('authorization', 'Bearer ' + auth)
+            return res
     return RelInfo(rel)
 
 
+OTOOL_HEADER_RE = re.compile(r'^(\S.*?)(?: \(architecture \S+\))?:\n', re.M)
+DEP_RE = re.compile(r'^\s*(.+?)\s+\(compatibility ')
+BLACKLIST = ('/System/', '/usr/lib/')
+
+
+def otool_deps(names):
+    """
+    Run a single otool -L on all the given names, returning a dict
+    name -> list of dependencies
+    """
+    res = {}
+    if not names:
+        return res
+    r = subprocess.run(['otool', '-L'] + list(names), capture_output=True,
+                       encoding='utf-8')
+    # fat binaries get one section per architecture
+    bits = OTOOL_HEADER_RE.split(r.stdout)
+    for name, out in zip(bits[1::2], bits[2::2]):
+        deps = res.setdefault(name, [])
+        for line in out.splitlines():
+            m = DEP_RE.match(line)
+            if not m:
+                continue
+            lib = m.group(1)
+            if lib not in deps:
+                deps.append(lib)
+    return res
+
+
+def macho_deps(names):
+    """
+    Same as otool_deps, but reading the dylib load commands directly with
+    macholib, without spawning any process. Names that macholib can't parse
+    are left out of the result
+    """
+    res = {}
+    for name in names:
+        try:
+            m = MachO(name, allow_unknown_load_commands=True)
+        except (OSError, ValueError, struct.error):
+            continue
+        deps = res[name] = []
+        for hdr in m.headers:
+            for _, _, lib in hdr.walkRelocatables():
+                if lib not in deps:
+                    deps.append(lib)
+    return res
+
+
+OTOOL_CACHE = os.path.expanduser('~/Library/Caches/ART-bundle/otool.json')
+otool_cache = None
+
+
+def get_otool_cache():
+    global otool_cache
+    if otool_cache is None:
+        try:
+            with open(OTOOL_CACHE) as f:
+                otool_cache = json.load(f)
+        except (OSError, ValueError):
+            otool_cache = {}
+        atexit.register(save_otool_cache)
+    return otool_cache
+
+
+def save_otool_cache():
+    try:
+        os.makedirs(os.path.dirname(OTOOL_CACHE), exist_ok=True)
+        tmp = OTOOL_CACHE + '.tmp'
+        with open(tmp, 'w') as out:
+            json.dump(otool_cache, out)
+        os.replace(tmp, OTOOL_CACHE)
+    except OSError as e:
+        sys.stderr.write(f'WARNING: could not save {OTOOL_CACHE}: {e}\n')
+
+
+def file_stamp(name):
+    try:
+        st = os.stat(name)
+    except OSError:
+        return None
+    return f'{st.st_mtime_ns}:{st.st_size}'
+
+
+def otool_deps_cached(names):
+    """
+    Like otool_deps, but consulting the on-disk cache first. Cache entries
+    are keyed by absolute path and validated against mtime and size. The
+    cache misses are parsed with macholib if available; those it can't parse
+    (or all of them, without macholib) are split among parallel otool
+    invocations
+    """
+    cache = get_otool_cache()
+    res = {}
+    todo = []
+    for name in names:
+        entry = cache.get(os.path.abspath(name))
+        if entry is not None and entry['stamp'] == file_stamp(name):
+            res[name] = entry['deps']
+        else:
+            todo.append(name)
+    if todo and MachO is not None:
+        res.update(macho_deps(todo))
+    rest = [name for name in todo if name not in res]
+    if rest:
+        nworkers = min(os.cpu_count() or 1, len(rest))
+        chunks = [rest[i::nworkers] for i in range(nworkers)]
+        with ThreadPoolExecutor(max_workers=nworkers) as ex:
+            for out in ex.map(otool_deps, chunks):
+                res.update(out)
+    for name in todo:
+        stamp = file_stamp(name)
+        if name in res and stamp is not None:
+            cache[os.path.abspath(name)] = {'stamp': stamp,
+                                            'deps': res[name]}
+    return res
+
+
 def getdlls(opts):
-    blacklist = ['/System/', '/usr/lib/']
     res = set()
-    d = os.path.join(os.getcwd(), 'Contents/MacOS')
-    to_process = [os.path.join(d, 'ART'),
-                  os.path.join(getprefix(opts), 'bin/dbus-daemon')]
+    art = os.path.join(os.getcwd(), 'Contents/MacOS/ART')
+    frontier = {art, os.path.join(getprefix(opts), 'bin/dbus-daemon')}
+    # getprefix might have already computed the dependencies of ART
+    known = {}
+    if opts.art_deps is not None:
+        known[art] = opts.art_deps
+    # index the contents of the rpath dirs, so that @rpath references can
+    # be resolved without probing each dir
+    rpath_idx = {}
+    for p in opts.rpath or []:
+        try:
+            with os.scandir(p) as it:
+                for e in it:
+                    rpath_idx.setdefault(e.name, e.path)
+        except OSError:
+            pass
     if opts.verbose:
         print('========== getdlls ==========')
     seen = set()
-    while to_process:
-        name = to_process[-1]
-        to_process.pop()
-        if name in seen:
-            continue
-        seen.add(name)
+    while frontier:
+        frontier -= seen
+        seen |= frontier
         if opts.verbose:
-            print(f'computing dependencies for: {name}')
-        r = subprocess.run(['otool', '-L', name], capture_output=True,
-                           encoding='utf-8')
-        out = r.stdout
-        for line in out.splitlines()[1:]:
-            line = line.strip()
-            bits = line.split('(compatibility ')
-            lib = bits[0].strip()
-            if lib.startswith('@rpath/'):
-                bn = lib[7:]
-                for p in opts.rpath:
-                    plib = os.path.join(p, bn)
-                    if os.path.exists(plib):
-                        lib = plib
-                        break
-            if not any(lib.startswith(p) for p in blacklist):
-                if opts.verbose:
-                    print(f'   {lib}')
-                res.add(lib)
-                to_process.append(lib)
+            for name in sorted(frontier):
+                print(f'computing dependencies for: {name}')
+        out = {name: known[name] for name in frontier if name in known}
+        out.update(otool_deps_cached(sorted(frontier - known.keys())))
+        next_frontier = set()
+        for deps in out.values():
+            for lib in deps:
+                if lib.startswith('@rpath/'):
+                    bn = lib[7:]
+                    if '/' not in bn:
+                        lib = rpath_idx.get(bn, lib)
+                    else:
+                        for p in opts.rpath or []:
+                            plib = os.path.join(p, bn)
+                            if os.path.exists(plib):
+                                lib = plib
+                                break
+                if not lib.startswith(BLACKLIST):
+                    if opts.verbose:
+                        print(f'   {lib}')
+                    res.add(lib)
+                    next_frontier.add(lib)
+        frontier = next_frontier
     if opts.verbose:
         print('=============================')
     return sorted(res)
@@ -113,19 +260,87 @@ def getdlls(opts):
 def getprefix(opts):
     if opts.prefix:
         return opts.prefix
-    d = os.path.join(os.getcwd(), 'Contents/MacOS')
-    p = subprocess.Popen(['otool', '-L', os.path.join(d, 'ART')],
-                         stdout=subprocess.PIPE)
-    out, _ = p.communicate()
-    for line in out.decode('utf-8').splitlines()[1:]:
-        line = line.strip()
-        bits = line.split('(compatibility ')
-        lib = bits[0].strip()
+    art = os.path.join(os.getcwd(), 'Contents/MacOS/ART')
+    opts.art_deps = otool_deps_cached([art]).get(art, [])
+    for lib in opts.art_deps:
         if 'libgtk-3.0' in lib:
             return os.path.dirname(os.path.dirname(lib))
     assert False, "can't determine prefix"
 
 
+def fetch_imageio(opts, imageio, name, dest):
+    with urlopen(imageio.asset(f'{name}.tar.gz')) as f:
+        if opts.verbose:
+            print(f'downloading and unpacking {name}.tar.gz from GitHub ...')
+        # bsdtar detects the compression format by itself
+        with subprocess.Popen(['/usr/bin/tar', '-xf', '-', '-C', dest,
+                               '--strip-components=1'],
+                              stdin=subprocess.PIPE) as p:
+            shutil.copyfileobj(f, p.stdin, 1 << 20)
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, p.args)
+
+
+def fetch_all_imageio(opts, targets):
+    """
+    Resolve the imageio releases and fetch the given (name, dest) archives
+    concurrently
+    """
+    imageio = get_imageio_releases()
+    with ThreadPoolExecutor(max_workers=len(targets)) as ex:
+        futures = [ex.submit(fetch_imageio, opts, imageio, name, dest)
+                   for name, dest in targets]
+        for f in futures:
+            f.result()
+
+
+def start_imageio_downloads(opts, executor):
+    """
+    Download the imageio archives in the background, unpacking them directly
+    into the bundle. Returns the list of futures to wait for
+    """
+    targets = []
+    if opts.imageio_download:
+        dest = os.path.join(opts.outdir, 'Contents/Resources/imageio')
+        if not opts.imageio:
+            os.makedirs(dest, exist_ok=True)
+            targets.append(('ART-imageio', dest))
+        if not opts.imageio_bin:
+            arch = 'x64' if platform.machine() == 'x86_64' else 'arm64'
+            bindest = os.path.join(dest, 'bin')
+            os.makedirs(bindest, exist_ok=True)
+            targets.append(('ART-imageio-bin-macOS-' + arch, bindest))
+    if not targets:
+        return []
+    # the release lookup is a network round trip as well, so it also
+    # happens in the background
+    return [executor.submit(fetch_all_imageio, opts, targets)]
+
+
+def find_files(dirname, suffix):
+    """
+    Iterate over the files in dirname whose name ends with suffix. Thanks to
+    os.scandir, only symlinks need an extra stat call
+    """
+    try:
+        with os.scandir(dirname) as it:
+            for e in it:
+                if e.name.endswith(suffix) and e.is_file():
+                    yield e.path
+    except OSError:
+        pass
+
+
+def find_dirs(dirname, pattern):
+    try:
+        with os.scandir(dirname) as it:
+            for e in it:
+                if fnmatch.fnmatch(e.name, pattern) and e.is_dir():
+                    yield e.path
+    except OSError:
+        pass
+
+
 def extra_files(opts):
     pref = getprefix(opts)
     def D(s): return os.path.expanduser(s)
@@ -136,45 +351,17 @@ def extra_files(opts):
                    ('/usr/local/bin/lib', 'lib')])]
     else:
         extra = []
-    imageio = get_imageio_releases() if opts.imageio_download else None
     if opts.imageio:
         extra.append(('Contents/Resources', [(opts.imageio, 'imageio')]))
-    elif opts.imageio_download:
-        with urlopen(imageio.asset('ART-imageio.tar.gz')) as f:
-            if opts.verbose:
-                print('downloading ART-imageio.tar.gz '
-                      'from GitHub ...')
-            tf = tarfile.open(fileobj=io.BytesIO(f.read()))
-            if opts.verbose:
-                print('unpacking ART-imageio.tar.gz ...')
-            tf.extractall(opts.tempdir)
-        extra.append(('Contents/Resources',
-                      [(os.path.join(opts.tempdir, 'ART-imageio'),
-                        'imageio')]))
     if opts.imageio_bin:
         extra.append(('Contents/Resources/imageio',
                       [(opts.imageio_bin, 'bin')]))
-    elif opts.imageio_download:
-        arch = 'x64' if platform.machine() == 'x86_64' else 'arm64'
-        name = f'ART-imageio-bin-macOS-' + arch
-        with urlopen(imageio.asset(f'{name}.tar.gz')) as f:
-            if opts.verbose:
-                print(f'downloading {name}.tar.gz from GitHub ...')
-            tf = tarfile.open(fileobj=io.BytesIO(f.read()))
-            if opts.verbose:
-                print(f'unpacking {name} ...')
-            tf.extractall(opts.tempdir)
-        extra.append(('Contents/Resources/imageio',
-                      [(os.path.join(opts.tempdir, name),
-                        'bin')]))
     return [
         ('Contents/Frameworks',
-         glob.glob(os.path.join(pref,
-                                'lib/gdk-pixbuf-2.0/2.10.0/'
-                                'loaders/*.so'))),
+         list(find_files(P('lib/gdk-pixbuf-2.0/2.10.0/loaders'), '.so'))),
         ('Contents/Frameworks',
-         glob.glob(os.path.join(pref,
-                                'lib/gtk-3.0/3*/immodules/*.so'))),
+         [f for v in find_dirs(P('lib/gtk-3.0'), '3*')
+          for f in find_files(os.path.join(v, 'immodules'), '.so')]),
         ('Contents/Resources', [
             os.path.join(pref, 'bin/gtk-query-immodules-3.0'),
             os.path.join(pref, 'bin/gdk-pixbuf-query-loaders'),
@@ -206,6 +393,50 @@ def extra_files(opts):
     ] + extra
 
 
+COPYFILE_ALL = 0xF
+COPYFILE_CLONE = 1 << 24
+try:
+    libc_copyfile = ctypes.CDLL('/usr/lib/libSystem.dylib').copyfile
+    libc_copyfile.argtypes = [ctypes.c_char_p, ctypes.c_char_p,
+                              ctypes.c_void_p, ctypes.c_uint32]
+    libc_copyfile.restype = ctypes.c_int
+except (OSError, AttributeError):
+    libc_copyfile = None
+
+
+def clone_copy(src, dest):
+    """
+    Replacement for shutil.copy2 that uses copyfile(3) with COPYFILE_CLONE,
+    so that on APFS files are cloned instead of copied. COPYFILE_CLONE does
+    not follow symlinks, hence src is resolved first
+    """
+    if libc_copyfile is not None:
+        rc = libc_copyfile(os.fsencode(os.path.realpath(src)),
+                           os.fsencode(dest), None,
+                           COPYFILE_CLONE | COPYFILE_ALL)
+        if rc == 0:
+            return dest
+    return shutil.copy2(src, dest)
+
+
+def fast_copy(src, dest):
+    """
+    Copy src to dest, cloning files on APFS. Single files are copied
+    in-process with clone_copy; directories with cp -c, which uses
+    clonefile(2), falling back to shutil.copytree (e.g. when src and dest
+    are on different volumes). Directories are merged into dest
+    """
+    if not os.path.isdir(src):
+        clone_copy(src, dest)
+        return
+    cmd = ['cp', '-c', '-p', '-R', '-L', os.path.join(src, ''), dest]
+    try:
+        subprocess.run(cmd, check=True, capture_output=True)
+    except subprocess.CalledProcessError:
+        shutil.copytree(src, dest, copy_function=clone_copy,
+                        dirs_exist_ok=True)
+
+
 def get_version(opts):
     with open('Contents/Resources/AboutThisBuild.txt') as f:
         for line in f:
@@ -274,19 +505,26 @@ def make_info_plist(opts):
 """)
 
 
+def link_or_copy(src, dest):
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
 def make_icns(opts):
     icondir = os.path.join(opts.tempdir, 'ART.iconset')
     os.mkdir(icondir)
     for i, sz in enumerate([16, 32, 64, 128, 256, 512]):
-        shutil.copy2(os.path.join('Contents/Resources/images',
+        link_or_copy(os.path.join('Contents/Resources/images',
                                   f'ART-logo-{sz}.png'),
                      os.path.join(icondir, f'icon_{sz}x{sz}.png'))
         if i > 0:
             sz2 = sz / 2
-            shutil.copy2(os.path.join('Contents/Resources/images',
+            link_or_copy(os.path.join('Contents/Resources/images',
                                       f'ART-logo-{sz}.png'),
                          os.path.join(icondir, f'icon_{sz2}x{sz2}@2x.png'))
-    shutil.copy2(os.path.join('Contents/Resources/images',
+    link_or_copy(os.path.join('Contents/Resources/images',
                               'ART-logo-1024.png'),
                  os.path.join(icondir, 'icon_512x512@2x.png'))
     subprocess.run(['iconutil', '-c', 'icns', 'ART.iconset'], check=True,
@@ -298,7 +536,8 @@ def make_icns(opts):
 def make_dmg(opts):
     if opts.verbose:
         print(f'Creating dmg in {opts.outdir}/{opts.dmg_name}.dmg ...')
-    subprocess.run(['hdiutil', 'create', '-format', 'UDBZ',
+    fmt = 'UDBZ' if opts.slow_dmg else 'ULFO'
+    subprocess.run(['hdiutil', 'create', '-format', fmt, '-nospotlight',
                     '-fs', 'HFS+', '-srcdir', 'ART.app',
                     '-volname', opts.dmg_name,
                     f'{opts.dmg_name}.dmg'],
@@ -471,46 +710,60 @@ def main():
         sys.stderr.write('ERROR: ART not found! Please run this script '
                          'from the build directory of ART\n')
         sys.exit(1)
-    if opts.verbose:
-        print('copying %s to %s' % (os.getcwd(), opts.outdir))
-    shutil.copytree(d, opts.outdir)
-    if not os.path.exists(os.path.join(opts.outdir, 'Contents/Frameworks')):
-        os.mkdir(os.path.join(opts.outdir, 'Contents/Frameworks'))
-    for lib in getdlls(opts):
+    if os.path.exists(opts.outdir):
+        sys.stderr.write(f'ERROR: {opts.outdir} already exists\n')
+        sys.exit(1)
+    # compute the prefix only once, subsequent getprefix calls return it
+    opts.prefix = getprefix(opts)
+    with tempfile.TemporaryDirectory() as tmpdir, \
+         ThreadPoolExecutor(max_workers=4) as ex:
+        opts.tempdir = tmpdir
         if opts.verbose:
-            print('copying: %s' % lib)
-        try:
-            shutil.copy2(lib,
-                         os.path.join(opts.outdir, 'Contents/Frameworks',
-                                      os.path.basename(lib)))
-        except FileNotFoundError as e:
-            sys.stderr.write(f'WARNING: {lib} not found, skipping\n')
-    with tempfile.TemporaryDirectory() as d:
-        opts.tempdir = d
-        for key, elems in extra_files(opts):
-            for elem in elems:
-                name = None
-                if isinstance(elem, tuple):
-                    elem, name = elem
-                else:
-                    name = os.path.basename(elem)
+            print('copying %s to %s' % (os.getcwd(), opts.outdir))
+        os.makedirs(os.path.dirname(opts.outdir), exist_ok=True)
+        fast_copy(d, opts.outdir)
+        # these are independent of each other and of the dependency walk
+        tasks = start_imageio_downloads(opts, ex)
+        tasks.append(ex.submit(make_icns, opts))
+        if opts.use_launcher:
+            tasks.append(ex.submit(build_launcher, opts, 'ART'))
+        if not os.path.exists(os.path.join(opts.outdir,
+                                           'Contents/Frameworks')):
+            os.mkdir(os.path.join(opts.outdir, 'Contents/Frameworks'))
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            copies = []
+            for lib in getdlls(opts):
+                if not os.path.exists(lib):
+                    sys.stderr.write(f'WARNING: {lib} not found, skipping\n')
+                    continue
                 if opts.verbose:
-                    print('copying: %s' % elem)
-                if not os.path.exists(elem):
-                    print('SKIPPING non-existing: %s' % elem)
-                elif os.path.isdir(elem):
-                    shutil.copytree(elem, os.path.join(opts.outdir, key, name))
-                else:
+                    print('copying: %s' % lib)
+                dest = os.path.join(opts.outdir, 'Contents/Frameworks',
+                                    os.path.basename(lib))
+                copies.append(pool.submit(fast_copy, lib, dest))
+            for key, elems in extra_files(opts):
+                for elem in elems:
+                    name = None
+                    if isinstance(elem, tuple):
+                        elem, name = elem
+                    else:
+                        name = os.path.basename(elem)
+                    if opts.verbose:
+                        print('copying: %s' % elem)
+                    if not os.path.exists(elem):
+                        print('SKIPPING non-existing: %s' % elem)
+                        continue
                     dest = os.path.join(opts.outdir, key, name)
-                    destdir = os.path.dirname(dest)
-                    if not os.path.exists(destdir):
-                        os.makedirs(destdir)
-                    shutil.copy2(elem, dest)
+                    # create the destination directories upfront, so that
+                    # parallel copies into nested locations don't race
+                    if os.path.isdir(elem):
+                        os.makedirs(dest, exist_ok=True)
+                    else:
+                        os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    copies.append(pool.submit(fast_copy, elem, dest))
+            for f in copies + tasks:
+                f.result()
         make_info_plist(opts)
-        make_icns(opts)
-
-        if opts.use_launcher:
-            build_launcher(opts, 'ART')
 
     os.makedirs(os.path.join(opts.outdir, 'Contents/Resources/share/gtk-3.0'))
     with open(os.path.join(opts.outdir,
@@ -53,16 +53,22 @@ def get_imageio_releases():
     class RelInfo:
         def __init__(self, rel):
             self.rels = sorted(rel, key=key, reverse=True)
-            
-        def asset(self, name):
+            # in the same order asset() used to scan, so setdefault keeps the
+            # same match
+            self.by_name = {}
             for rel in self.rels:
                 for asset in rel['assets']:
-                    if asset['name'] == name:
-                        res = Request(asset['browser_download_url'])
-                        if auth is not None:
-                            res.add_header('authorization', 'Bearer ' + auth)
-                        return res
-            return None
+                    self.by_name.setdefault(asset['name'],
+                                            asset['browser_download_url'])
+            
+        def asset(self, name):
+            url = self.by_name.get(name)
+            if url is None:
+                return None
+            res = Request(url)
+            if auth is not None:
+                res.add_header('authorization', 'Bearer ' + auth)
+            return res
     return RelInfo(rel)
 
 